@@ -2,7 +2,6 @@
 import sys, os
 from almost_make.utils.printUtil import *
 import almost_make.utils.makeUtil as makeUtility
-import almost_make.utils.macroUtil as macroUtility
 from almost_make.utils.argsUtil import *
 from almost_make import version
 
@@ -90,6 +89,9 @@ def printHelp():
     print()
     cprint("Note: ", FORMAT_COLORS['PURPLE'])
     print("AlmostMake's built-in shell is currently very limited.")
+    cprint("Note: ", FORMAT_COLORS['PURPLE'])
+    print("Each $(shell ...) command runs every time it is expanded. To reuse a command's output until the next" +
+" command runs or an export changes the environment, define _SHELL_CACHE (e.g. _SHELL_CACHE := 1).")
     print()
     cprint("Note: ", FORMAT_COLORS['PURPLE'])
     print("Macro definitions that override those from the environment" +
@@ -117,13 +119,12 @@ def main(args=sys.argv):
     elif 'version' in args:
         version.printVersion()
     else:
-        macroUtil = macroUtility.MacroUtil()
         makeUtil = makeUtility.MakeUtil()
 
         fileName = 'Makefile'
         targets = []
         
-        defaultMacros = macroUtil.getDefaultMacros() # Fills with macros from environment, etc.
+        defaultMacros = makeUtil.macroUtil.getDefaultMacros() # Fills with macros from environment, etc.
         overrideMacros = {}
         
         if 'directory' in args:
@@ -204,7 +205,7 @@ def main(args=sys.argv):
             for target in targets:
                 makeUtil.runMakefile(fileContents, target, defaultMacros, overrideMacros)
         else:
-            contents, macros = macroUtil.expandAndDefineMacros(fileContents, defaultMacros)
+            contents, macros = makeUtil.macroUtil.expandAndDefineMacros(fileContents, defaultMacros)
             contents, macros = makeUtil.handleIncludes(contents, macros)
             print(contents)
 
@@ -2,13 +2,19 @@
 
 from almost_make.utils.printUtil import *
 
+FORMAT_MESSAGES = sys.stderr.isatty() # Only color messages if stderr is a terminal.
+
 class ErrorUtil:
-    stopOnError = True
-    silent = False
+    __slots__ = ('stopOnError', 'silent')
+
+    def __init__(self):
+        self.stopOnError = True
+        self.silent = False
+
     # On error, report [message] depending on [SILENT] and [STOP_ON_ERROR]
     def reportError(self, message):
         if not self.silent or self.stopOnError:
-            cprint(str(message) + "\n", "RED", file=sys.stderr)
+            self.printMessage(str(message) + "\n", "RED")
         
         if self.stopOnError:
             print ("Stopping.")
@@ -16,7 +22,16 @@ class ErrorUtil:
     
     def logWarning(self, message):
         if not self.silent:
-            cprint(str("Warning: ") + str(message) + "\n", "YELLOW", file=sys.stderr)
+            self.printMessage(str("Warning: ") + str(message) + "\n", "YELLOW")
+
+    # Print [text] to stderr, in [color] only if stderr is a terminal.
+    # The message is sent with a single write.
+    def printMessage(self, text, color):
+        if FORMAT_MESSAGES:
+            text = FORMAT_COLORS[color] + text + FORMAT_RESET
+        
+        sys.stderr.write(text)
+        sys.stderr.flush()
 
     # Option-setting functions
     def setStopOnError(self, stopOnErr):
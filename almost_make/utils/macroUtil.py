@@ -2,32 +2,56 @@
 
 # Macro parsing utilities.
 
-import re, os
+import re, os, sys, string, threading
+from collections import OrderedDict, deque
 import almost_make.utils.shellUtil.runner as runner
 import almost_make.utils.errorUtil as errorUtil
 
 # Regular expressions:
 MACRO_NAME_EXP = "[a-zA-Z0-9_\\@\\^\\<]"
-MACRO_NAME_CHAR_REGEXP = re.compile(MACRO_NAME_EXP)
-MACRO_SET_REGEXP = re.compile("\\s*([:+?]?)\\=\\s*")
-IS_MACRO_DEF_REGEXP = re.compile("^%s+\\s*[:+?]?\\=.*" % MACRO_NAME_EXP, re.IGNORECASE)
-IS_MACRO_INVOKE_REGEXP = re.compile(".*(?:[\\$])[\\(\\{]?%s+[\\)\\}]?" % MACRO_NAME_EXP)
-SPACE_CHARS = re.compile("\\s")
+MACRO_DEF_REGEXP = re.compile("(?P<name>%s+)\\s*(?P<op>[:+?]?)\\=\\s*(?P<value>.*)" % MACRO_NAME_EXP, re.DOTALL)
+IS_MACRO_INVOKE_REGEXP = re.compile("[\\$][\\(\\{]?%s+" % MACRO_NAME_EXP) # Use with .search
+
+# Tokens relevant to comment-stripping: escaped characters, (possibly unterminated)
+# quoted strings, brackets, and comment characters.
+COMMENT_SCAN_REGEXP = re.compile(r"""\\.|"(?:[^"\\]|\\.)*"?|'(?:[^'\\]|\\.)*'?|[(){}#]""", re.DOTALL)
+# Characters that can hide a comment or cause a bracket mismatch.
+COMMENT_SCAN_SPECIAL_CHARS_REGEXP = re.compile(r"""[\\"')}]""")
+
+# Simple macro usages: $(NAME), ${NAME}, $NAME, and $$. The expansion of a line containing
+# only these depends only on the values of the named macros.
+SIMPLE_MACRO_USAGE_REGEXP = re.compile(r"\$(?:\((%s*)\)|\{(%s*)\}|(%s*)(?!%s|[(){}$])|\$)"
+    % (MACRO_NAME_EXP, MACRO_NAME_EXP, MACRO_NAME_EXP, MACRO_NAME_EXP))
+# Characters that change the nesting level of a macro usage.
+MACRO_BRACKET_REGEXP = re.compile(r"[(){}]")
 
 CONDITIONAL_START = re.compile(r"^\s*(ifeq|ifneq|ifdef|ifndef)(?:\s|$)")
 CONDITIONAL_ELSE = re.compile(r"^\s*(else)(?:\s|$)")
 CONDITIONAL_STOP = re.compile(r"^\s*(endif)(?:\s|$)")
+CONDITIONAL_FIRST_CHARS = { 'i', 'e' }
 
 # Constant(s)
 COMMENT_CHAR = '#'
+MACRO_NAME_CHARS = frozenset(string.ascii_letters + string.digits + '_@^<') # Same as MACRO_NAME_EXP.
+MAX_EXPANSION_CACHE_SIZE = 1024 # Maximum number of lines remembered by expandMacroUsages.
 
 class MacroUtil:
-    macroCommands = {} # All commands executable as $(name arg1, arg2, ...)
-    definitionConditions = [] # A list of additional preconditions for the definition of a macro.
-    lazyEvalConditions = []   # Don't expand macros on a line when in define & expand mode if any of these conditions are true.
-    conditionals = False
-    errorLogger = errorUtil.ErrorUtil()
-    expandUndefinedMacrosTo = None
+    __slots__ = (
+        'macroCommands', 'definitionConditions', 'lazyEvalConditions', 'conditionals',
+        'errorLogger', 'expandUndefinedMacrosTo', 'expansionCache', 'expansionCacheLock',
+        'exportListeners'
+    )
+
+    def __init__(self):
+        self.macroCommands = {} # All commands executable as $(name arg1, arg2, ...)
+        self.definitionConditions = [] # A list of additional preconditions for the definition of a macro.
+        self.lazyEvalConditions = []   # Don't expand macros on a line when in define & expand mode if any of these conditions are true.
+        self.conditionals = False
+        self.errorLogger = errorUtil.ErrorUtil()
+        self.expandUndefinedMacrosTo = None
+        self.expansionCache = OrderedDict() # Least-recently-used expansions are first.
+        self.expansionCacheLock = threading.Lock()
+        self.exportListeners = [] # Called with a macro's name when exporting it changes os.environ.
     
     def setStopOnError(self, stopOnErr):
         self.errorLogger.setStopOnError(stopOnErr)
@@ -48,6 +72,11 @@ class MacroUtil:
     def addLazyEvalCondition(self, condition):
         self.lazyEvalConditions.append(condition)
 
+    # Call listener(name) whenever expandAndDefineMacros exports
+    # a macro, changing the environment.
+    def addExportListener(self, listener):
+        self.exportListeners.append(listener)
+
     # Turn on conditional support!
     def enableConditionals(self):
         self.conditionals = True
@@ -63,12 +92,24 @@ class MacroUtil:
     
     # Get if [text] defines a macro.
     def isMacroDef(self, text):
-        if IS_MACRO_DEF_REGEXP.match(text) == None:
-            return False
+        return self.getMacroDefParts(text) != None
+
+    # Get a tuple (name, operator, value) from the macro definition in [text].
+    # For example, "CC ?= gcc" -> ("CC", "?", "gcc"). Returns None if [text]
+    # does not define a macro.
+    def getMacroDefParts(self, text):
+        if not '=' in text:
+            return None
+
+        match = MACRO_DEF_REGEXP.match(text)
+        if match == None:
+            return None
+        if not self.definitionConditions: # Common case: no additional preconditions.
+            return match.group('name', 'op', 'value')
         for condition in self.definitionConditions:
             if not condition(text):
-                return False
-        return True
+                return None
+        return match.group('name', 'op', 'value')
 
     # Get whether [text] defines a macro with value that should be exported to the
     # environment.
@@ -79,10 +120,15 @@ class MacroUtil:
 
     # Get if [text] syntatically invokes a macro.
     def isMacroInvoke(self, text):
-        return IS_MACRO_INVOKE_REGEXP.match(text) != None
+        return '$' in text and IS_MACRO_INVOKE_REGEXP.search(text) != None
 
-    # Get if [text] is a conditional statement.
+    # Get if [text] is a conditional statement. If it is, the returned
+    # value is the match object for the keyword (group 1).
     def isConditional(self, text):
+        # All conditional keywords (if..., else, endif) start with 'i' or 'e'.
+        if not text.lstrip()[:1] in CONDITIONAL_FIRST_CHARS:
+            return False
+
         if self.shouldLazyEval(text): # Lazy evaluation for this line? Skip it.
             return False
 
@@ -166,185 +212,276 @@ From %s, parsed arguments: %s""" %
 
     # Get a list of suggested default macros from the environment
     def getDefaultMacros(self):
-        result = { }
-        
-        for name in os.environ:
-            result[name] = os.environ[name]
-        
-        return result
+        return dict(os.environ)
 
     # Split content by lines, but
     # paying attention to escaped newline
     # characters.
     def getLines(self, content):
+        lines = content.split('\n')
+
+        if not '\\' in content:
+            return lines
+
         result = []
-        escapeCharLast = False
-        buff = ''
-
-        for c in content:
-            if c == '\\' and not escapeCharLast:
-                escapeCharLast = True
-            elif escapeCharLast and c != '\n':
-                buff += '\\' + c
-                escapeCharLast = False
-            elif escapeCharLast and c == '\n':
-                buff += ' '
-                escapeCharLast = False
-            elif c == '\n':
-                result.append(buff)
-                buff = ''
-            else:
-                escapeCharLast = False
-                buff += c
+        continued = [] # Parts of a line that ends with an escaped newline.
 
-        result.append(buff)
+        for line in lines:
+            # An odd number of trailing backslashes escapes the newline. Escaped newlines
+            # are replaced with a space.
+            if line.endswith('\\') and (len(line) - len(line.rstrip('\\'))) % 2 == 1:
+                continued.append(line[:-1])
+                continue
+            
+            continued.append(line)
+            result.append(' '.join(continued))
+            continued = []
+
+        # A trailing, lone backslash is dropped.
+        if len(continued) > 0:
+            result.append(' '.join(continued))
         return result
 
     # Remove comments from line as defined
     # by COMMENT_CHAR
     def stripComments(self, line, force=False):
-        singleLevel = { '"': False, "\'": False }
-        inSomeSingleLevel = False
-        multiLevelOpen = { '(': 0, '{': 0 }
-        multiLevelClose = { ')': '(', '}': '{' }
-        escaped = False
-        trimToIndex = 0
-
-        for c in line:
-            if c in singleLevel and not escaped:
-                if not inSomeSingleLevel:
-                    inSomeSingleLevel = True
-                    singleLevel[c] = True
-                elif singleLevel[c]:
-                    inSomeSingleLevel = False
-                    singleLevel[c] = False
-            elif c == '\\' and not escaped:
-                escaped = True
-            elif c == '\\' and escaped:
-                escaped = False
-            elif c in multiLevelOpen and not escaped and not inSomeSingleLevel:
-                multiLevelOpen[c] += 1
-            elif c in multiLevelClose and not escaped and not inSomeSingleLevel:
-                bracketPairChar = multiLevelClose[c]
-                if multiLevelOpen[bracketPairChar] == 0:
-                    self.errorLogger.reportError("Parentheses mismatch on line with content: %s" % line)
-                else:
-                    multiLevelOpen[bracketPairChar] -= 1
-            elif c == COMMENT_CHAR and not escaped and not inSomeSingleLevel and (not self.shouldLazyEval(line) or force):
-                break
+        commentIndex = line.find(COMMENT_CHAR)
+        canStrip = commentIndex != -1 and (force or not self.shouldLazyEval(line))
+
+        # Fast path: if nothing before the first comment character is special,
+        # we don't need to tokenize. Without a comment character, the line is
+        # only scanned to report unmatched closing brackets.
+        if commentIndex == -1:
+            if not ')' in line and not '}' in line:
+                return line
+        elif COMMENT_SCAN_SPECIAL_CHARS_REGEXP.search(line, 0, commentIndex) is None and canStrip:
+            return line[:commentIndex]
+
+        parenDepth = 0
+        braceDepth = 0
+
+        for match in COMMENT_SCAN_REGEXP.finditer(line):
+            token = match.group(0)
+
+            # Quoted strings and escaped characters can't end the line.
+            if len(token) > 1:
+                continue
+            elif token == '(':
+                parenDepth += 1
+            elif token == '{':
+                braceDepth += 1
+            elif token == ')' and parenDepth > 0:
+                parenDepth -= 1
+            elif token == '}' and braceDepth > 0:
+                braceDepth -= 1
+            elif token == ')' or token == '}':
+                self.errorLogger.reportError("Parentheses mismatch on line with content: %s" % line)
+            elif token == COMMENT_CHAR and canStrip:
+                return line[:match.start()]
+        return line
+
+    # Get a key identifying the expansion of [line] with [macros], or None if
+    # the expansion of [line] can't be cached (e.g. it calls macro commands,
+    # which may have side-effects).
+    def getExpansionCacheKey(self, line, macros):
+        values = []
+        understoodCount = 0 # Number of '$' characters in simple macro usages.
+
+        for match in SIMPLE_MACRO_USAGE_REGEXP.finditer(line):
+            if match.lastindex is None: # $$
+                understoodCount += 2
+                continue
+            
+            understoodCount += 1
+            name = match.group(match.lastindex)
+
+            value = macros.get(name)
+
+            if value is not None:
+                values.append(value)
+            elif name in self.macroCommands or self.expandUndefinedMacrosTo is None:
+                return None
             else:
-                escaped = False
-            trimToIndex = trimToIndex + 1
-        return line[:trimToIndex]
+                values.append(None)
+
+        # Anything we didn't understand?
+        if understoodCount != line.count('$'):
+            return None
+        
+        return (line, self.expandUndefinedMacrosTo, tuple(values))
 
     # Expand usages of [macros] in [line]. Make no definitions and expand
     # regardless of lazyEvalConditions.
     def expandMacroUsages(self, line, macros):
-        expanded = ''
-        buff = ''
-        afterBuff = ''
+        # Nothing to expand? Searching for '$' is much faster than scanning
+        # the line character-by-character.
+        if not '$' in line:
+            return line
+
+        cacheKey = self.getExpansionCacheKey(line, macros)
+
+        if cacheKey is not None:
+            with self.expansionCacheLock:
+                if cacheKey in self.expansionCache:
+                    self.expansionCache.move_to_end(cacheKey)
+                    return self.expansionCache[cacheKey]
+
+        expanded = []
+        buff = []
+        afterBuff = []
         parenLevel = 0
         inMacro = False
         buffFromMacro = False
 
         line += ' ' # Force any macros at the
                     # end of the line to expand.
+        lineLength = len(line)
+        index = 0
+
+        while index < lineLength:
+            # Outside of macro usages, only '$' is significant: jump to the
+            # next one, copying the text before it.
+            if not inMacro:
+                dollarIndex = line.find('$', index)
 
-        for c in line:
-            if c == '$' and not inMacro and parenLevel == 0:
-                expanded += buff
-                buff = ''
+                if dollarIndex == -1:
+                    buff.append(line[index:])
+                    break
+
+                expanded.append(line[index:dollarIndex])
+                index = dollarIndex + 1
                 inMacro = True
-            elif c == '$' and parenLevel == 0 and inMacro and buff == '':
+                continue
+
+            # Inside brackets, only other brackets are significant: copy
+            # everything up to the next one at once.
+            if parenLevel > 0:
+                bracket = MACRO_BRACKET_REGEXP.search(line, index)
+                nextIndex = bracket.start() if bracket != None else lineLength
+
+                if nextIndex > index:
+                    buff.append(line[index:nextIndex])
+                    index = nextIndex
+                    continue
+
+            c = line[index]
+            index += 1
+
+            if c == '$' and parenLevel == 0 and not buff:
                 inMacro = False
-                expanded += '$'
-            elif (c == '(' or c == '{') and inMacro:
+                expanded.append('$')
+            elif c == '(' or c == '{':
                 parenLevel += 1
 
                 if parenLevel > 1:
-                    buff += c
-            elif (c == ')' or c == '}') and inMacro:
+                    buff.append(c)
+            elif c == ')' or c == '}':
                 parenLevel -= 1
 
                 if parenLevel == 0:
                     inMacro = False
                     buffFromMacro = True
                 else:
-                    buff += c
-            elif inMacro and parenLevel == 0 and not MACRO_NAME_CHAR_REGEXP.match(c):
+                    buff.append(c)
+            elif parenLevel == 0 and not c in MACRO_NAME_CHARS:
                 inMacro = False
                 buffFromMacro = True
-                afterBuff += c
+                afterBuff.append(c)
             else:
-                buff += c
+                buff.append(c)
 
             if buffFromMacro:
                 buffFromMacro = False
-                buff = buff.lstrip()
-                words = SPACE_CHARS.split(buff)
-
-                if buff in macros:
-                    buff = macros[buff]
-                elif words[0] in self.macroCommands:
-                    argText = self.expandMacroUsages(" ".join(words[1:]), macros)
-                    buff = self.macroCommands[words[0]](argText, macros)
+                usage = ''.join(buff).lstrip()
+                words = usage.split(None, 1) # [ name, arguments ] for macro commands.
+
+                value = macros.get(usage) # Macro values are never None.
+
+                if value is not None:
+                    usage = value
+                elif words and words[0] in self.macroCommands:
+                    argText = self.expandMacroUsages(words[1] if len(words) > 1 else '', macros)
+                    usage = self.macroCommands[words[0]](argText, macros)
                 elif self.expandUndefinedMacrosTo is None:
                     # If no default macro value, display an error message.
-                    self.errorLogger.reportError("Undefined macro %s. Context: %s." % (buff, line))
+                    self.errorLogger.reportError("Undefined macro %s. Context: %s." % (usage, line))
                 else:
-                    buff = self.expandUndefinedMacrosTo # If we continue, expand to nothing.
+                    usage = self.expandUndefinedMacrosTo # If we continue, expand to nothing.
 
-                expanded += buff + afterBuff
-#               print("Expanded to %s." % (buff + afterBuff))
-                buff = ''
-                afterBuff = ''
+                expanded.append(usage)
+                expanded.extend(afterBuff)
+#               print("Expanded to %s." % (usage + ''.join(afterBuff)))
+                buff = []
+                afterBuff = []
         
         if parenLevel > 0:
             self.errorLogger.reportError("Unclosed parenthesis: %s" % line)
 
         # Append buff, but ignore trailing space.
-        expanded += buff[:len(buff) - 1] + afterBuff
+        expanded.append(''.join(buff)[:-1])
+        expanded.extend(afterBuff)
+        expanded = ''.join(expanded)
+
+        if cacheKey is not None:
+            with self.expansionCacheLock:
+                self.expansionCache[cacheKey] = expanded
+
+                if len(self.expansionCache) > MAX_EXPANSION_CACHE_SIZE:
+                    self.expansionCache.popitem(last=False)
         return expanded
 
     # Expand and handle macro definitions 
     # in [contents]. This includes removing end-of-line comments.
     def expandAndDefineMacros(self, contents, macros = {}):
-        lines = self.getLines(contents)
-        result = ''
+        lines = deque(self.getLines(contents))
+        result = [] # Segments of the output. Joined once, at the end.
         conditionalData = None
 
-        for line in lines:
-            line = self.stripComments(line)
-            exporting = self.isMacroExport(line)
+        # This loop runs once per line: look up frequently-used methods only once.
+        popLine = lines.popleft
+        appendResult = result.append
+        stripComments = self.stripComments
+        isConditional = self.isConditional
+        shouldLazyEval = self.shouldLazyEval
+        getMacroDefParts = self.getMacroDefParts
+        expandMacroUsages = self.expandMacroUsages
+        isMacroInvoke = self.isMacroInvoke
+        matchConditionalStart = CONDITIONAL_START.match
+
+        while len(lines) > 0:
+            line = stripComments(popLine())
             
             if conditionalData != None:
-                if self.isConditional(line):
-                    if CONDITIONAL_START.match(line):
+                conditionalMatch = isConditional(line)
+
+                if conditionalMatch:
+                    keyword = conditionalMatch.group(1)
+
+                    if conditionalMatch.re is CONDITIONAL_START:
                         conditionalData['stack'].append(line)
                         conditionalData['endifWeight'].append(1)
                     # We ignore CONDITIONAL_ELSE unless it applies directly to THIS conditional.
-                    elif CONDITIONAL_ELSE.match(line) and len(conditionalData['stack']) == conditionalData['endifWeight'][-1]:
-                        elseText = CONDITIONAL_ELSE.match(line).group(1)
+                    elif keyword == 'else' and len(conditionalData['stack']) == conditionalData['endifWeight'][-1]:
 #                        print("Else: " + line)
-                        line = line.strip()[len(elseText):].strip() # Move anything after 'else' onto the next line (conceptually). Permits else if...
+                        line = line.strip()[len(keyword):].strip() # Move anything after 'else' onto the next line (conceptually). Permits else if...
 
-                        if not conditionalData['elseBranch']:
-                            conditionalData['elseBranch'] = ''
+                        if conditionalData['elseBranch'] is None:
+                            conditionalData['elseBranch'] = []
                         else:
-                            conditionalData['elseBranch'] += 'else\n'
-                        conditionalData['elseBranch'] += line + '\n' # We can start building-up the else branch...
+                            conditionalData['elseBranch'].append('else\n')
+                        conditionalData['elseBranch'].append(line + '\n') # We can start building-up the else branch...
 
                         # Is it an else if?
-                        if CONDITIONAL_START.match(line):
+                        if matchConditionalStart(line):
                             conditionalData['stack'].append(line) # Treat it like an if.
                             conditionalData['endifWeight'].append(conditionalData['endifWeight'][-1] + 1) # The next endif removes two elements from the stack.
 
                         continue
-                    elif CONDITIONAL_STOP.match(line):
+                    elif keyword == 'endif':
 #                        print(str(len(conditionalData['stack'])) + "," + line + ",  wt:" + str(conditionalData['endifWeight'][-1]))
 
                         while conditionalData['endifWeight'][-1] > 1:
-                            conditionalData['elseBranch'] += 'endif\n'
+                            conditionalData['elseBranch'].append('endif\n')
                             conditionalData['stack'].pop()
                             conditionalData['endifWeight'][-1] -= 1
                         
@@ -358,34 +495,47 @@ From %s, parsed arguments: %s""" %
                             
                             ifConditional = conditionalData['stack'].pop() # Contents of the if statement.
 
-                            elsePart = conditionalData['elseBranch'] or ''
+                            elsePart = ''.join(conditionalData['elseBranch'] or [])
 
                             chosenBranch = self.evaluateIf(ifConditional, 
-                                conditionalData['ifBranch'], elsePart, macros)
+                                ''.join(conditionalData['ifBranch']), elsePart, macros)
                             
-                            # We have reached the end of the branch. Add a version to result.
-                            expanded, macros = self.expandAndDefineMacros(chosenBranch, macros)
-                            result += expanded + '\n'
+                            # We have reached the end of the branch. Handle its lines next,
+                            # followed by an empty line in place of the endif.
+                            lines.extendleft(reversed(chosenBranch.split('\n') + [ '' ]))
 
                             conditionalData = None # We are done!
                             continue
                 if conditionalData['elseBranch'] != None:
-                    conditionalData['elseBranch'] += line + '\n'
+                    conditionalData['elseBranch'].append(line + '\n')
                 else:
-                    conditionalData['ifBranch'] += line + '\n'
+                    conditionalData['ifBranch'].append(line + '\n')
                 continue
 
+            # Fast path: without '=' or '$', a line can't define or use macros. Unless
+            # it starts a conditional, it is kept as-is.
+            conditionalMatch = self.conditionals and isConditional(line)
+
+            if not '=' in line and not '$' in line and not conditionalMatch:
+                appendResult(line)
+                appendResult('\n')
+                continue
+
+            definition = None
+            exporting = False
+
+            if line.startswith("export "):
+                definition = getMacroDefParts(line[len("export "):].lstrip())
+                exporting = definition != None
+
+            if definition == None:
+                definition = getMacroDefParts(line)
+
             # If either a macro export, or a setting a macro's value, without an export...
-            if (self.isMacroDef(line) or exporting):
-                if exporting:
-                    line = line[len("export "):]
-                
-                parts = MACRO_SET_REGEXP.split(line)
-                name = parts[0]
-                definedTo = line[len(name):]
-                definedTo = MACRO_SET_REGEXP.sub("", definedTo, count=1) # Remove the first set character.
-                defineType = MACRO_SET_REGEXP.search(line).group(1) # E.g. :,+,? so we can do += or ?=
-                name = name.strip()
+            if definition != None:
+                # defineType is, e.g., :,+,? so we can do += or ?=
+                name, defineType, definedTo = definition
+                name = sys.intern(name) # Macro names are used as keys many times.
                 
                 doNotDefine = False
                 concatWith = ''
@@ -394,40 +544,49 @@ From %s, parsed arguments: %s""" %
                 # ?=, so only define if undefined.
                 if defineType == '?' and name in macros:
                     doNotDefine = True
-                elif defineType == '+' and name in macros:
-                    concatWith = macros[name]
+                elif defineType == '+':
+                    concatWith = macros.get(name, '')
                 elif defineType == '':
                     deferExpand = True
                 
                 # Depending on the operator, we might not want to define the macro...
                 if not doNotDefine:
                     if not deferExpand:
-                        macros[name] = concatWith + self.expandMacroUsages(definedTo, macros).rstrip('\n')
+                        macros[name] = concatWith + expandMacroUsages(definedTo, macros).rstrip('\n')
                     else:
 #                    print("Expansion defered: %s = %s" % (name, definedTo))
-                        macros[name] = concatWith + definedTo.rstrip('\n')
+                        macros[name] = concatWith + definedTo # getLines split on '\n', so there are no trailing newlines.
                     
-                if exporting:
+                # Setting os.environ calls putenv. Skip it if the value is unchanged.
+                if exporting and os.environ.get(name) != macros[name]:
                     os.environ[name] = macros[name]
+
+                    for listener in self.exportListeners:
+                        listener(name)
 #            print("%s defined to %s" % (name, macros[name]))
-            elif self.conditionals and self.isConditional(line) and not self.shouldLazyEval(line):
+            elif conditionalMatch: # isConditional is False for lines that should be lazily evaluated.
 #                      Ref:
 #                      https://www.gnu.org/software/make/manual/html_node/Conditional-Syntax.html#Conditional-Syntax
-                conditional = self.getConditional(line)
+                conditional = conditionalMatch.group(1)
 
-                # The conditional must, initially, be some if...
-                if not CONDITIONAL_START.match(conditional):
-                    self.errorLogger.reportError("%s without a leading if. Context: %s. Buffer: %s" % (conditional, line, result))
-                
-                conditionalData = { 'ifBranch': '', 'elseBranch': None, 'stack': [], 'endifWeight': [ 1 ] }
-                conditionalData['stack'].append(line)
-            elif self.isMacroInvoke(line) and not self.shouldLazyEval(line):
-                result += self.expandMacroUsages(line, macros)
+                # The conditional must, initially, be some if... If it isn't, skip it (rather
+                # than treating the following lines as part of a conditional).
+                if not conditionalMatch.re is CONDITIONAL_START:
+                    self.errorLogger.reportError("%s without a leading if. Context: %s. Buffer: %s" % (conditional, line, ''.join(result)))
+                else:
+                    conditionalData = { 'ifBranch': [], 'elseBranch': None, 'stack': [], 'endifWeight': [ 1 ] }
+                    conditionalData['stack'].append(line)
+            elif isMacroInvoke(line) and not shouldLazyEval(line):
+                appendResult(expandMacroUsages(line, macros))
             else:
-                result += line
-            result += '\n'
+                appendResult(line)
+            appendResult('\n')
 
         if not conditionalData is None:
+            conditionalData['ifBranch'] = ''.join(conditionalData['ifBranch'])
+            if conditionalData['elseBranch'] != None:
+                conditionalData['elseBranch'] = ''.join(conditionalData['elseBranch'])
+
             self.errorLogger.reportError("Un-ending conditional (check your indentation -- leading tabs can mess things up)! Conditional data: %s." % str(conditionalData))
         
-        return (result, macros)
+        return (''.join(result), macros)
@@ -20,7 +20,6 @@ import almost_make.utils.shellUtil.escapeParser as escaper
 import almost_make.utils.errorUtil as errorUtility
 
 # Regular expressions
-SPACE_CHARS = re.compile(r'\s+')
 INCLUDE_DIRECTIVE_EXP = re.compile(r"^\s*(include|\.include|-include|sinclude)\s+")
 
 # Targets that are used by this parser/should be ignored.
@@ -33,24 +32,38 @@ MAGIC_TARGETS = \
 class MakeUtil:
     recipeStartChar = '\t'
     silent = False
-    macroCommands = {}
     maxJobs = 1
-    currentJobs = 1 # Number of currently running jobs...
-    jobLock = threading.Lock()
-    pending = {} # Set of pending jobs.
     justPrint = False # Print commands, without evaluating.
 
     def __init__(self):
-        self.macroCommands["words"] = lambda argstring, macros: str(len(SPACE_CHARS.split(self.macroUtil.expandMacroUsages(argstring, macros))))
-        self.macroCommands["sort"] = lambda argstring, macros: " ".join(sorted(list(set(SPACE_CHARS.split(self.macroUtil.expandMacroUsages(argstring, macros))))))
+        self.macroCommands = {}
+        self.jobSlots = threading.BoundedSemaphore(self.maxJobs - 1) # Jobs that can run in addition to this thread.
+        self.pending = {} # Set of pending jobs.
+        self.targetActionsCache = {} # Maps (content, recipeStartChar) to the result of getTargetActions.
+        self.statCache = {} # Maps paths to os.stat results (None if missing). Cleared when commands run.
+        self.searchPathCache = {} # Maps values of VPATH to search paths. Cleared when commands run.
+        self.globCache = {} # Maps (pattern, VPATH) to results of glob. Cleared when commands run.
+        self.realpathCache = {} # Maps paths to results of os.path.realpath. Cleared when commands run.
+        self.shellCache = {} # Maps commands run by $(shell ...) to their output, if _SHELL_CACHE is defined. See makeCmdShell.
+        self.patternRecipeCache = {} # Maps rule lines to results of isPatternSubstRecipe.
+        self.patsubstCache = {} # Maps (pattern, replacement) to results of parsePatsubst.
+        self.ruleIndex = None # (targets, number of indexed keys, index). See getRuleIndex.
+        self.ruleIndexLock = threading.Lock()
+        self.targetClaims = {} # Maps targets considered by the current call to runMakefile to Events, set once generated.
+        self.targetClaimsLock = threading.Lock()
+        self.claimWaits = {} # Maps thread ids to (buildChain, target) for threads waiting on other jobs' claims.
+        self.phonySet = (None, frozenset()) # (.PHONY dependency list, set of its entries). See isPhony.
+
+        self.macroCommands["words"] = lambda argstring, macros: str(len(self.macroUtil.expandMacroUsages(argstring, macros).split()))
+        self.macroCommands["sort"] = lambda argstring, macros: " ".join(sorted(set(self.macroUtil.expandMacroUsages(argstring, macros).split())))
         self.macroCommands["strip"] = lambda argstring, macros: argstring.strip()
 
-        self.macroCommands["shell"] = lambda code, macros: os.popen(self.macroUtil.expandMacroUsages(code, macros)).read().rstrip(' \n\r\t') # To-do: Use the built-in shell if specified...
+        self.macroCommands["shell"] = lambda code, macros: self.makeCmdShell(code, macros)
         self.macroCommands["wildcard"] = lambda argstring, macros: " ".join([ shlex.quote(part) for part in self.glob(self.macroUtil.expandMacroUsages(argstring, macros), macros) ])
-        self.macroCommands["dir"] = lambda argstring, macros: " ".join([ os.path.dirname(arg) for arg in SPACE_CHARS.split(self.macroUtil.expandMacroUsages(argstring, macros)) ])
-        self.macroCommands["notdir"] = lambda argstring, macros: " ".join([ os.path.basename(arg) for arg in SPACE_CHARS.split(self.macroUtil.expandMacroUsages(argstring, macros)) ])
-        self.macroCommands["abspath"] = lambda argstring, macros: " ".join([ os.path.abspath(arg) for arg in SPACE_CHARS.split(self.macroUtil.expandMacroUsages(argstring, macros)) ])
-        self.macroCommands["realpath"] = lambda argstring, macros: " ".join([ os.path.realpath(arg) for arg in SPACE_CHARS.split(self.macroUtil.expandMacroUsages(argstring, macros)) ])
+        self.macroCommands["dir"] = lambda argstring, macros: " ".join(map(os.path.dirname, self.macroUtil.expandMacroUsages(argstring, macros).split()))
+        self.macroCommands["notdir"] = lambda argstring, macros: " ".join(map(os.path.basename, self.macroUtil.expandMacroUsages(argstring, macros).split()))
+        self.macroCommands["abspath"] = lambda argstring, macros: " ".join(map(os.path.abspath, self.macroUtil.expandMacroUsages(argstring, macros).split()))
+        self.macroCommands["realpath"] = lambda argstring, macros: " ".join(map(self.realpath, self.macroUtil.expandMacroUsages(argstring, macros).split()))
 
         self.macroCommands["subst"] = lambda argstring, macros: self.makeCmdSubst(argstring, macros)
         self.macroCommands["patsubst"] = lambda argstring, macros: self.makeCmdSubst(argstring, macros, True)
@@ -67,6 +80,7 @@ class MakeUtil:
         self.macroUtil.setMacroCommands(self.macroCommands)
         self.macroUtil.addMacroDefCondition(lambda line: not line.startswith(self.recipeStartChar))
         self.macroUtil.addLazyEvalCondition(lambda line: line.startswith(self.recipeStartChar))
+        self.macroUtil.addExportListener(lambda name: self.clearShellCache()) # $(shell ...) output can depend on the environment.
 
         # Makefiles seem to generally expect undefined macros to expand to nothing...
         self.setDefaultMacroExpansion("")
@@ -93,6 +107,7 @@ class MakeUtil:
     # this number of jobs to be used/created.
     def setMaxJobs(self, maxJobs):
         self.maxJobs = maxJobs
+        self.jobSlots = threading.BoundedSemaphore(max(maxJobs - 1, 0))
 
     # Get a tuple.
     # First item: a map from target names
@@ -100,87 +115,131 @@ class MakeUtil:
     # Second item: A list of the targets
     #   with recipies.
     # This method parses the text of a makefile.
+    # Results are cached: running several targets from the same makefile
+    # only parses it once.
     def getTargetActions(self, content):
-        lines = content.split('\n')
-        lines.reverse()
-        
-        result = {}
-        currentRecipe = []
-        targetNames = []
-        specialTargetNames = []
+        cacheKey = (content, self.recipeStartChar)
 
-        for line in lines:
+        if not cacheKey in self.targetActionsCache:
+            self.targetActionsCache[cacheKey] = self.parseTargetActions(content)
+
+        # Callers add generated recipes to the map of targets: give each a copy.
+        result, targetNames = self.targetActionsCache[cacheKey]
+        return (dict(result), list(targetNames))
+
+    # Parse the text of a makefile. See getTargetActions.
+    def parseTargetActions(self, content):
+        rules = [] # (rule line, index of ':', recipe) tuples, in order.
+        currentRecipe = None
+        separatorlessLines = [] # Lines without a ':' since the last rule.
+        misplacedLines = [] # Lines without a ':', followed by part of a recipe.
+
+        for line in content.split('\n'):
             if line.startswith(self.recipeStartChar):
-                currentRecipe.append(line[len(self.recipeStartChar) : ]) 
-                # Use len() in case we decide to 
-                # be less compliant and make it 
-                # more than a character.
+                misplacedLines.extend(separatorlessLines)
+                separatorlessLines = []
+
+                # Recipe lines before the first rule are ignored.
+                if currentRecipe != None:
+                    currentRecipe.append(line[len(self.recipeStartChar) : ])
+                    # Use len() in case we decide to 
+                    # be less compliant and make it 
+                    # more than a character.
             elif len(line.strip()) > 0:
-                if not ':' in line:
-                    if len(currentRecipe) > 0:
-                        self.errorUtil.reportError("Pre-recipe line must contain separator! Line: %s" % line)
+                sepIndex = line.find(':')
+
+                if sepIndex == -1:
+                    separatorlessLines.append(line)
                     continue
-                sepIndex = line.index(':')
-
-                # Get what is generated (the targets).
-                allGenerates = runner.shSplit(line[:sepIndex].strip(), { ' ', '\t', '\n', ';' })
-                allGenerates = runner.removeEqual(allGenerates, ';')
-                allGenerates = runner.removeEmpty(allGenerates)
-
-                # Get the dependencies (everything after the colon).
-                preReqs = line[sepIndex + 1 :].strip()
-                dependsOn = runner.shSplit(preReqs, { ' ', '\t', '\n', ';' })
-                dependsOn = runner.removeEqual(dependsOn, ';')
-                dependsOn = runner.removeEmpty(dependsOn)
-
-                if self.isPatternSubstRecipe(line):
-                    currentRecipe.reverse()
-                    result[line] = ((allGenerates, dependsOn), currentRecipe)
-                else:
-                    for generates in allGenerates:
-                        currentDeps = []
-                        currentDeps.extend(dependsOn)
-                        
-                        if generates in result:
-                            oldDeps, oldRecipe = result[generates]
-                            currentDeps.extend(oldDeps)
-                            oldRecipe.reverse()
-                            currentRecipe.extend(oldRecipe)
-                        
-                        # Clean up & add to output.
-                        outRecipe = [] + currentRecipe
-                        outRecipe.reverse()
-                        result[generates] = (currentDeps, outRecipe)
-
-                        if generates.startswith('.'):
-                            specialTargetNames.append(generates)
-                        else:
-                            targetNames.append(generates)
+
+                separatorlessLines = []
                 currentRecipe = []
+                rules.append((line, sepIndex, currentRecipe))
+
+        # Report errors bottom-to-top.
+        for line in reversed(misplacedLines):
+            self.errorUtil.reportError("Pre-recipe line must contain separator! Line: %s" % line)
+
+        result = {}
+        targetNames = []
+        specialTargetNames = []
+
+        # Rules are handled bottom-to-top: if a target has several rules, the dependencies
+        # of earlier rules come first, while the recipes of later rules do.
+        for line, sepIndex, recipe in reversed(rules):
+            # Get what is generated (the targets).
+            allGenerates = runner.shSplit(line[:sepIndex].strip(), { ' ', '\t', '\n', ';' })
+            allGenerates = runner.removeEqual(allGenerates, ';')
+            allGenerates = runner.removeEmpty(allGenerates)
+
+            # Get the dependencies (everything after the colon).
+            preReqs = line[sepIndex + 1 :].strip()
+            dependsOn = runner.shSplit(preReqs, { ' ', '\t', '\n', ';' })
+            dependsOn = runner.removeEqual(dependsOn, ';')
+            dependsOn = runner.removeEmpty(dependsOn)
+
+            if self.isPatternSubstRecipe(line):
+                result[line] = ((allGenerates, dependsOn), recipe)
+            else:
+                for generates in allGenerates:
+                    currentDeps = []
+                    currentDeps.extend(dependsOn)
+
+                    existing = result.get(generates)
+
+                    if existing != None:
+                        oldDeps, oldRecipe = existing
+                        currentDeps.extend(oldDeps)
+
+                        recipe = oldRecipe + recipe # Also used for this rule's remaining targets.
+
+                    result[generates] = (currentDeps, list(recipe))
+
+                    if generates.startswith('.'):
+                        specialTargetNames.append(generates)
+                    else:
+                        targetNames.append(generates)
         # Move targets that start with a '.' to
         # the end...
         targetNames.reverse()
         targetNames.extend(specialTargetNames)
         return (result, targetNames)
     
+    # Get whether [line] contains an unescaped '%'. generateRecipeFor
+    # checks every rule for each target it looks for, so results are cached.
     def isPatternSubstRecipe(self, line):
         if not '%' in line:
             return False
-        parts = escaper.escapeSafeSplit(line, '%', '\\')
 
-        return len(parts) > 1
+        result = self.patternRecipeCache.get(line)
+
+        if result == None:
+            parts = escaper.escapeSafeSplit(line, '%', '\\')
+            result = len(parts) > 1
+            self.patternRecipeCache[line] = result
+        return result
 
     # Get a list of directories (including the current working directory)
     # from macros['VPATH']. Returns an array with one element, the current working
-    # directory, if there is no 'VPATH' macro.
+    # directory, if there is no 'VPATH' macro. The result is cached, and should
+    # not be modified.
     def getSearchPath(self, macros):
+        vpath = macros.get('VPATH')
+        searchPath = self.searchPathCache.get(vpath)
+
+        if searchPath == None:
+            searchPath = self.computeSearchPath(vpath)
+            self.searchPathCache[vpath] = searchPath
+        return searchPath
+
+    # Get the search path for the given value of VPATH (None if undefined).
+    # See getSearchPath.
+    def computeSearchPath(self, vpath):
         searchPath = [ os.path.abspath('.') ]
         
-        if not 'VPATH' in macros:
+        if vpath == None:
             return searchPath
 
-        vpath = macros['VPATH']
-
         # Split first by ';', then by ':', then finally,
         # try to split by space characters.
         splitOrder = [';', ':', ' ']
@@ -196,23 +255,86 @@ class MakeUtil:
 
         return searchPath
 
+    # Forget cached information about files and directories. Call this
+    # when they might have changed.
+    def clearFileCaches(self):
+        self.statCache = {}
+        self.searchPathCache = {}
+        self.globCache = {}
+        self.realpathCache = {}
+        self.ruleIndex = None # Maps absolute paths, which depend on the current directory.
+
+    # Get the result of os.stat([path]), or None, if [path] does not exist.
+    # Results are cached until the next command is run. When running several
+    # jobs, files can change at any time, so nothing is cached.
+    def statFile(self, path):
+        cache = self.statCache
+
+        if path in cache:
+            return cache[path]
+
+        try:
+            result = os.stat(path)
+        except OSError:
+            result = None
+
+        if self.maxJobs == 1:
+            cache[path] = result
+        return result
+
+    # Get os.path.realpath([path]), cached like statFile.
+    def realpath(self, path):
+        cache = self.realpathCache
+
+        if path in cache:
+            return cache[path]
+
+        result = os.path.realpath(path)
+
+        if self.maxJobs == 1:
+            cache[path] = result
+        return result
+
     # Find a file with relative path [givenPath]. If 
     # VPATH is in macros, search each semi-colon, colon,
     # or space-separated entry for the file. Returns the 
     # path to the file, or None, if the file does not exist.
     def findFile(self, givenPath, macros):
+        path, _ = self.findFileStat(givenPath, macros)
+        return path
+
+    # Like findFile, but returns a tuple (path, os.stat result), or
+    # (None, None), if the file does not exist.
+    def findFileStat(self, givenPath, macros):
         givenPath = os.path.normcase(givenPath)
         searchPath = self.getSearchPath(macros)
 
         for part in searchPath:
             path = os.path.join(part, givenPath)
+            stat = self.statFile(path)
 
-            if os.path.exists(path):
-                return os.path.relpath(path)
-        return None
+            if stat != None:
+                return (os.path.relpath(path), stat)
+        return (None, None)
 
-    # Glob [text], but search [VPATH] for additional matches.
+    # Glob [text], but search [VPATH] for additional matches. Like statFile, results
+    # are cached until the next command is run (if running only one job) and should not
+    # be modified.
     def glob(self, text, macros):
+        cacheKey = (text, macros.get('VPATH'))
+        cache = self.globCache
+
+        if cacheKey in cache:
+            return cache[cacheKey]
+
+        result = self.computeGlob(text, macros)
+
+        if self.maxJobs == 1:
+            cache[cacheKey] = result
+        return result
+
+    # Glob [text], searching [VPATH]. See glob.
+    def computeGlob(self, text, macros):
         if not 'VPATH' in macros:
             return globber.glob(text, '.')
         
@@ -254,8 +376,13 @@ class MakeUtil:
         generatedTarget = False
         potentialNewRules = []
 
-        # Can we generate a recipe?
-        for key in targets.keys():
+        # Can we generate a recipe? Only pattern rules, suffix rules, and rules
+        # for the same path can apply. Check them in the order they were defined.
+        patternRules, suffixRules, rulesByPath = self.getRuleIndex(targets)
+        candidates = patternRules + suffixRules + rulesByPath.get(os.path.abspath(target), [])
+        candidates.sort()
+
+        for _, key in candidates:
             if self.isPatternSubstRecipe(key):
                 details, rules = targets[key]
                 generates, deps = details
@@ -341,15 +468,61 @@ class MakeUtil:
                 fewestUngeneratableDeps = unsatisfiableCount
         return generatedTarget
 
+    # Group the keys of [targets] by the kinds of rules they define, for use
+    # by generateRecipeFor. Returns a tuple (patternRules, suffixRules, rulesByPath).
+    # The lists contain (position, key) pairs, where position is the index of the key
+    # in [targets]. rulesByPath maps absolute paths to lists of pairs for other rules.
+    # Only keys added since the last call are indexed.
+    def getRuleIndex(self, targets):
+        with self.ruleIndexLock:
+            return self.updateRuleIndex(targets)
+
+    # Update and return the index for [targets]. See getRuleIndex.
+    def updateRuleIndex(self, targets):
+        cached = self.ruleIndex
+
+        if cached == None or not cached[0] is targets:
+            cached = (targets, 0, ([], [], {}))
+        
+        _, indexedCount, index = cached
+
+        if indexedCount < len(targets):
+            patternRules, suffixRules, rulesByPath = index
+            keys = list(targets)
+
+            for position in range(indexedCount, len(keys)):
+                key = keys[position]
+
+                if self.isPatternSubstRecipe(key):
+                    patternRules.append((position, key))
+                elif key.startswith(".") and "." in key[1:]:
+                    suffixRules.append((position, key))
+                else:
+                    rulesByPath.setdefault(os.path.abspath(key), []).append((position, key))
+            cached = (targets, len(keys), index)
+
+        self.ruleIndex = cached
+        return index
+
     # Return True iff [target] is not a "phony" target
     # (as declared by .PHONY). [targets] is the list of all
     # targets.
     def isPhony(self, target, targets):
-        if not ".PHONY" in targets:
+        phonyRule = targets.get('.PHONY')
+
+        if phonyRule == None:
             return False
         
-        phonyTargets,_ = targets['.PHONY']
-        return target in phonyTargets or target in MAGIC_TARGETS
+        phonyTargets,_ = phonyRule
+        cachedList, phonySet = self.phonySet
+
+        # isPhony is called for every dependency: test membership
+        # against a set built once per .PHONY list, not the list itself.
+        if cachedList is not phonyTargets:
+            phonySet = frozenset(phonyTargets)
+            self.phonySet = (phonyTargets, phonySet)
+
+        return target in phonySet or target in MAGIC_TARGETS
 
     # Get whether [target] needs to be (re)generated. If necessary,
     # creates a rule for [target] and adds it to [targets].
@@ -368,11 +541,13 @@ class MakeUtil:
         if not target in targets:
             self.generateRecipeFor(target, targets, macros)
         
-        targetPath = self.findFile(target, macros)
+        targetPath, targetStat = self.findFileStat(target, macros)
         selfExists = targetPath != None
         selfMTime = 0
 
-        if not target in targets:
+        rule = targets.get(target)
+
+        if rule == None:
             if selfExists:
                 return False
             else:
@@ -381,11 +556,11 @@ class MakeUtil:
                 self.errorUtil.reportError("No rule to make %s." % target)
                 return False # If still running, we can't generate this.
         
-        deps, _ = targets[target]
+        deps, _ = rule
         deps = self.globArgs(runner.removeEmpty(deps), macros, False) # Glob the set of dependencies.
         
         if selfExists:
-            selfMTime = os.path.getmtime(targetPath)
+            selfMTime = targetStat.st_mtime
         else:
             return True
         
@@ -396,14 +571,14 @@ class MakeUtil:
             if self.isPhony(dep, targets):
                 return True
             
-            pathToOther = self.findFile(dep, macros)
+            pathToOther, otherStat = self.findFileStat(dep, macros)
 
             # If it doesn't exist...
             if pathToOther == None:
                 return True
 
             # If we're older than it...
-            if selfMTime < os.path.getmtime(pathToOther):
+            if selfMTime < otherStat.st_mtime:
                 return True
 
             visitingSet.add(target)
@@ -415,10 +590,74 @@ class MakeUtil:
         return False
 
     # Generate [target] if necessary (i.e. run recipes to create). Returns
-    # True if generated, False if not necessary.
-    def satisfyDependencies(self, target, targets, macros):
+    # True if generated, False if not necessary. [buildChain] contains the
+    # targets whose dependencies are being satisfied by this call's callers.
+    def satisfyDependencies(self, target, targets, macros, buildChain=()):
         target = target.strip()
 
+        if target in buildChain:
+            self.errorUtil.logWarning("Circular dependency involving %s!!!" % target)
+            return False
+
+        # Like GNU make, generate each target at most once. Claim the target before
+        # generating it, so that other jobs wait for it, rather than generating it again.
+        circular = False
+
+        with self.targetClaimsLock:
+            claim = self.targetClaims.get(target)
+            isOwner = claim == None
+
+            if isOwner:
+                claim = threading.Event()
+                self.targetClaims[target] = claim
+            elif not claim.is_set():
+                # Waiting for a job that is (indirectly) waiting for us would never finish.
+                circular = self.isWaitingOn(target, buildChain)
+
+                if not circular:
+                    self.claimWaits[threading.get_ident()] = (buildChain, target)
+
+        if circular:
+            self.errorUtil.logWarning("Circular dependency involving %s!!!" % target)
+            return False
+
+        if not isOwner:
+            claim.wait()
+
+            with self.targetClaimsLock:
+                self.claimWaits.pop(threading.get_ident(), None)
+            return False
+
+        try:
+            return self.generateTarget(target, targets, macros, buildChain + (target,))
+        finally:
+            claim.set()
+
+    # Get whether generating [target] is waiting, through other jobs' claims, for a
+    # target in [buildChain]. Must be called with targetClaimsLock held.
+    def isWaitingOn(self, target, buildChain):
+        toVisit = [ target ]
+        visited = set()
+
+        while len(toVisit) > 0:
+            current = toVisit.pop()
+
+            if current in buildChain:
+                return True
+            if current in visited:
+                continue
+            visited.add(current)
+
+            # Generating [current] waits for everything waited on while
+            # generating its dependencies.
+            for waiterChain, waitingFor in self.claimWaits.values():
+                if current in waiterChain:
+                    toVisit.append(waitingFor)
+        return False
+
+    # Satisfy the dependencies of [target] and run its recipe, if necessary.
+    # See satisfyDependencies.
+    def generateTarget(self, target, targets, macros, buildChain):
         if not self.prepareGenerateTarget(target, targets, macros):
             return False
         
@@ -439,30 +678,41 @@ class MakeUtil:
 
         for dep in deps:
     #        print("Checking dep %s; %s" % (dep, str(needGenerate(dep))))
-            if dep.strip() != "" and self.prepareGenerateTarget(dep, targets, macros):
-                self.jobLock.acquire()
-                if self.currentJobs < self.maxJobs and not dep in self.pending:
-                    self.currentJobs += 1
-                    self.jobLock.release()
-
-                    self.pending[dep] = threading.Thread(target=self.satisfyDependencies, args=(dep, targets, macros))
-
+            if dep.strip() == "":
+                continue
+
+            if dep.strip() in self.targetClaims:
+                # Already generated, or being generated by another job. Wait for it.
+                self.satisfyDependencies(dep, targets, macros, buildChain)
+            elif self.prepareGenerateTarget(dep, targets, macros):
+                job = None
+
+                if not dep in self.pending and self.jobSlots.acquire(blocking=False):
+                    job = threading.Thread(target=self.runJob, args=(dep, targets, macros, buildChain))
+
+                    # setdefault is atomic: if another thread registered a job for
+                    # dep first, give the slot back.
+                    if not self.pending.setdefault(dep, job) is job:
+                        self.jobSlots.release()
+                        job = None
+
+                if job != None:
+                    # Start the job now, so that it runs while we satisfy
+                    # the remaining dependencies on this thread.
+                    job.start()
                     pendingJobs.append(dep)
                 else:
-                    self.jobLock.release()
-                    self.satisfyDependencies(dep, targets, macros)
-
-        for job in pendingJobs:
-            self.pending[job].start()
+                    self.satisfyDependencies(dep, targets, macros, buildChain)
 
         # Wait for all pending jobs to complete.
         for job in pendingJobs:
             self.pending[job].join()
             self.pending[job] = None
 
-            self.jobLock.acquire()
-            self.currentJobs -= 1
-            self.jobLock.release()
+        # Recipes of different jobs can run at the same time. Give each its
+        # own automatic macros ($@, $^, $<).
+        if self.maxJobs > 1:
+            macros = dict(macros)
 
         # Here, we know that
         # (1) all dependencies are satisfied
@@ -508,12 +758,26 @@ class MakeUtil:
                 if haltOnFail: # e.g. -rm foo should be silent even if it cannot remove foo.
                     self.errorUtil.reportError("Unable to run command:\n    ``%s``. \n\n  Message:\n%s" % (command, str(e)))
             finally:
+                # The command may have created, changed, or removed files
+                # (or changed the current directory).
+                self.clearFileCaches()
+                self.clearShellCache()
+
                 # We should not switch directories, regardless of the command's result.
                 # Some platforms (e.g. a-Shell) do not reset the cwd after child processes exit.
                 if os.getcwd() != origDir:
                     os.chdir(origDir)
+
         return True
     
+    # Satisfy the dependencies of [target] as a separate job (see satisfyDependencies).
+    # The job's slot is released as soon as it finishes.
+    def runJob(self, target, targets, macros, buildChain=()):
+        try:
+            self.satisfyDependencies(target, targets, macros, buildChain)
+        finally:
+            self.jobSlots.release()
+
     # Handle all .include and include directives, as well as any conditionals.
     def handleIncludes(self, contents, macros):
         lines = self.macroUtil.getLines(contents)
@@ -585,6 +849,32 @@ class MakeUtil:
 
     ## Macro commands.
 
+    # Forget the output of $(shell ...) commands.
+    def clearShellCache(self):
+        self.shellCache = {}
+
+    # Example: $(shell echo foo) -> foo
+    # By default, each command runs every time it is expanded. If the _SHELL_CACHE
+    # macro is defined, the output of each command is instead reused until a command
+    # runs (in a recipe or an uncached $(shell ...)) or an export changes the environment.
+    def makeCmdShell(self, code, macros):
+        command = self.macroUtil.expandMacroUsages(code, macros)
+        useCache = "_SHELL_CACHE" in macros
+
+        if useCache and command in self.shellCache:
+            return self.shellCache[command]
+
+        # Like os.popen, capture only stdout. Errors are shown to the user.
+        output = subprocess.run(command, shell=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.rstrip(' \n\r\t') # To-do: Use the built-in shell if specified...
+
+        # The command may have changed files, so other commands' output may be stale.
+        self.clearFileCaches()
+        self.clearShellCache()
+
+        if useCache:
+            self.shellCache[command] = output
+        return output
+
     # Example: $(subst foo,bar,foobar baz) -> barbar baz
     # See https://www.gnu.org/software/make/manual/html_node/Syntax-of-Functions.html#Syntax-of-Functions
     #     and https://www.gnu.org/software/make/manual/html_node/Text-Functions.html
@@ -598,11 +888,16 @@ class MakeUtil:
         firstThreeArgs[2] = ','.join(args[2:])
         args = firstThreeArgs
 
-        replaceText = self.macroUtil.expandMacroUsages(args[0], macros)
-        replaceWith = self.macroUtil.expandMacroUsages(args[1], macros)
-        text        = self.macroUtil.expandMacroUsages(args[2], macros)
+        expandMacroUsages = self.macroUtil.expandMacroUsages
+        replaceText = expandMacroUsages(args[0], macros)
+        replaceWith = expandMacroUsages(args[1], macros)
+        text        = expandMacroUsages(args[2], macros)
 
         if not patternBased:
+            # re.sub interprets escapes in replaceWith. Without any, a plain
+            # (much faster) str.replace gives the same result.
+            if not '\\' in replaceWith:
+                return text.replace(replaceText, replaceWith)
             return re.sub(re.escape(replaceText), replaceWith, text)
         else: # Using $(patsubst pattern,replacement,text)
             return self.patsubst(replaceText, replaceWith, text)
@@ -645,7 +940,12 @@ class MakeUtil:
                 return ""
         
         argText = self.macroUtil.expandMacroUsages(argText, macros)
-        words = SPACE_CHARS.split(argText)
+
+        # Only split as much of argText as needed to find the selected word.
+        if selectIndex >= 0:
+            words = argText.split(None, selectIndex + 1)
+        else:
+            words = argText.rsplit(None, -selectIndex)
 
         # TODO: Is there a way to do this with if-statements?
         try:
@@ -653,25 +953,21 @@ class MakeUtil:
         except IndexError:
             return ""
 
-    # Replace all patterns defined by replaceText with replaceWith
-    # in text. 
-    def patsubst(self, replaceText, replaceWith, text):
-        words = SPACE_CHARS.split(text.strip())
-        result = []
+    # Parse the pattern and replacement given to patsubst into
+    # (replaceExact, staticReplace, prefix, suffix, replacePrefix, replaceSuffix).
+    # Results are cached, as patsubst is often called with the same arguments.
+    def parsePatsubst(self, replaceText, replaceWith):
+        key = (replaceText, replaceWith)
+        cached = self.patsubstCache.get(key)
+
+        if cached != None:
+            return cached
 
         pattern = escaper.escapeSafeSplit(replaceText, '%', '\\')
         replaceWith = escaper.escapeSafeSplit(replaceWith, '%', '\\')
 
-        replaceAll = False
-        replaceExact = False
-        staticReplace = False
-
-        if len(pattern) == 1:
-            replaceAll = pattern == ''
-            replaceExact = pattern[0]
-        
-        if len(replaceWith) <= 1:
-            staticReplace = True
+        replaceExact = len(pattern) == 1
+        staticReplace = len(replaceWith) <= 1
 
         while len(pattern) < 2:
             pattern.append('')
@@ -681,16 +977,38 @@ class MakeUtil:
         pattern[1] = '%'.join(pattern[1:])
         replaceWith[1] = '%'.join(replaceWith[1:])
 
-        for word in words:
-            if replaceExact == False and (replaceAll or  word.startswith(pattern[0]) and word.endswith(pattern[1])):
-                if not staticReplace:
-                    result.append(replaceWith[0] + word[len(pattern[0]) : -len(pattern[1])] + replaceWith[1])
-                else:
-                    result.append(replaceWith[0])
-            elif replaceExact == word.strip():
-                result.append('%'.join(runner.removeEmpty(replaceWith)))
-            else:
-                result.append(word)
+        # Without a '%' in the pattern, words equal to it are replaced with
+        # the replacement as a whole.
+        if replaceExact:
+            replaceWith = [ '%'.join(runner.removeEmpty(replaceWith)), '' ]
+
+        result = (replaceExact, staticReplace, pattern[0], pattern[1], replaceWith[0], replaceWith[1])
+        self.patsubstCache[key] = result
+        return result
+
+    # Replace all patterns defined by replaceText with replaceWith
+    # in text. 
+    def patsubst(self, replaceText, replaceWith, text):
+        words = text.split()
+        replaceExact, staticReplace, prefix, suffix, replacePrefix, replaceSuffix = \
+                self.parsePatsubst(replaceText, replaceWith)
+
+        # Without a '%' in the pattern, only replace words equal to it.
+        if replaceExact:
+            result = [ replacePrefix if word == prefix else word for word in words ]
+            return " ".join(runner.removeEmpty(result))
+
+        # Compare and slice with the same prefix and suffix for each word.
+        stemStart, stemEnd = len(prefix), -len(suffix)
+
+        # Choose between static and stem replacement once, rather than per word.
+        if staticReplace:
+            result = [ replacePrefix if word.startswith(prefix) and word.endswith(suffix) else word
+                        for word in words ]
+        else:
+            result = [ replacePrefix + word[stemStart : stemEnd] + replaceSuffix
+                        if word.startswith(prefix) and word.endswith(suffix) else word
+                        for word in words ]
         
         return " ".join(runner.removeEmpty(result))
 
@@ -700,6 +1018,12 @@ class MakeUtil:
     # dependencies of target by the contents
     # of the makefile given in contents.
     def runMakefile(self, contents, target = '', defaultMacros={ "MAKE": "almake" }, overrideMacros={}):
+        # Files, and the current directory, may have changed since the last run.
+        self.clearFileCaches()
+        self.clearShellCache()
+        self.targetClaims = {}
+        self.claimWaits = {}
+
         contents, macros = self.macroUtil.expandAndDefineMacros(contents, defaultMacros)
         contents, macros = self.handleIncludes(contents, macros)
         targetRecipes, targets = self.getTargetActions(contents)
@@ -30,7 +30,7 @@ def parseEscapes(text, escapes=DEFAULT_ESCAPE_SEQUENCES, escapeChar='\\'):
 # be escaped.
 def escapeSafeSplit(text, splitChar, escapeChar, splitInQuotes=True):
     result = []
-    buff = ""
+    buff = []
     escaped = False
     inQuotes = None
 
@@ -44,19 +44,19 @@ def escapeSafeSplit(text, splitChar, escapeChar, splitInQuotes=True):
             else:
                 inQuotes = char
             
-            buff += char
+            buff.append(char)
         elif char == splitChar and not escaped and inQuotes == None:
-            result.append(buff)
-            buff = ''
+            result.append(''.join(buff))
+            buff = []
         elif char == escapeChar and not escaped:
             escaped = True
         elif escaped:
             escaped = False
-            buff += char
+            buff.append(char)
         else:
-            buff += char
+            buff.append(char)
     
-    result.append(buff)
+    result.append(''.join(buff))
 
     return result
 
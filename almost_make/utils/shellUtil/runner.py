@@ -74,12 +74,15 @@ def unwrapParens(buff):
     result = []
     parenCount = getParenCount(buff)
 
-    result.append(re.sub(r"^[(]{" + str(parenCount) + r"}", "", buff[0]))
+    # The first and last parts start and end with at least parenCount parentheses,
+    # so slicing removes them (no need to build a regular expression for each call).
+    lastPart = buff[len(buff) - 1]
+    result.append(buff[0][parenCount:])
 
     for i in range(1, len(buff) - 1):
         result.append(buff[i])
 
-    result.append(re.sub(r"[)]{" + str(parenCount) + r"}$", "", buff[len(buff) - 1]))
+    result.append(lastPart[:len(lastPart) - parenCount])
 
     return removeEmpty(result)
 
@@ -358,11 +361,10 @@ def shSplit(text, splitChars={ '(', ')', '|', '&', '>', ';', ' ', '\t', '\n' },
     escaped = False
     inQuote = None
     result = []
-    buff = ""
+    buff = []
     
     # Split by spaces and parentheses (and other punctuation chars...).
     for char in text:
-        buff += char
         if char in quoteChars and not escaped:
             if inQuote == char:
                 inQuote = None
@@ -373,11 +375,13 @@ def shSplit(text, splitChars={ '(', ')', '|', '&', '>', ';', ' ', '\t', '\n' },
         elif escaped:
             escaped = False
         elif char in splitChars and inQuote == None:
-            result.append(buff[:-1])
+            result.append(''.join(buff))
             result.append(char)
-            buff = ""
+            buff = []
+            continue
+        buff.append(char)
     
-    result.append(buff)
+    result.append(''.join(buff))
     
     buff = ''
     filtered = []
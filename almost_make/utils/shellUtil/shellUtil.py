@@ -309,7 +309,7 @@ def customCat(args, stdin, stdout, stderr, state):
             cprint("%s\t" % str(lineNu), file=stdout)
         
         if 'show-tabs' in args:
-            line = re.sub(r'[\t]', '^T', line)
+            line = line.replace('\t', '^T')
         
         end = 'show-ends' in args and '$' or ''
         cprint(str(line) + end + "\n", file=stdout)